@@ -1,6 +1,8 @@
 """
 Provider for GitHub's v4 GraphQL API.
 """
+import functools
+
 import graphql
 
 from gqlmod.helpers.types import get_schema, get_type
@@ -44,19 +46,25 @@ class PreviewFinder(graphql.Visitor):
                 self.previews.add(d['toggledBy'])
 
 
-def _build_accept(previews):
-    if isinstance(previews, (list, tuple, set)):
-        if previews:
-            return ', '.join(
-                f"application/vnd.github.{p}+json"
-                for p in previews
-            )
-        else:
-            return "application/json"
+@functools.lru_cache(maxsize=64)
+def _accept_for(previews):
+    if isinstance(previews, tuple) and previews:
+        return ', '.join(
+            f"application/vnd.github.{p}+json"
+            for p in previews
+        )
     elif isinstance(previews, str):
         return f"application/vnd.github.{previews}+json"
-    elif previews is None:
+    else:
         return "application/json"
+
+
+def _build_accept(previews):
+    # Normalize to something hashable, so the header can be cached
+    if isinstance(previews, (list, tuple, set, frozenset)):
+        return _accept_for(tuple(previews))
+    elif isinstance(previews, str) or previews is None:
+        return _accept_for(previews)
     else:
         raise TypeError(f"Can't handle preview {previews!r}")
 
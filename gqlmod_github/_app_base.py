@@ -1,18 +1,96 @@
+import copy
+import datetime
 import time
-import jwcrypto.jwt
-import jwcrypto.jwk
+import jwt
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+from . import _build_accept
+
+try:
+    import orjson
+except ImportError:
+    import json
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+    _json_loads = json.loads
+else:
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+
+
+class GithubAPIError(Exception):
+    """
+    GitHub responded with an unexpected status.
+    """
+    def __init__(self, status, url, body):
+        super().__init__(status, url, body)
+        self.status = status
+        self.url = url
+        self.body = body
+
+    def __str__(self):
+        return f"{self.status}, url={self.url!r}\n{self.body}"
+
+
+def _find_link(value, rel):
+    """
+    Find the URL with the given rel in a Link header, or None if there isn't one.
+
+    Only handles the simple form GitHub sends: <url>; rel="next", <url>; rel="last"
+    """
+    if not value:
+        return None
+
+    idx = value.find(f'rel="{rel}"')
+    if idx == -1:
+        return None
+
+    start = value.rfind('<', 0, idx)
+    end = value.find('>', start, idx)
+    if start == -1 or end == -1:
+        return None
+
+    return value[start + 1:end]
+
+
+def _parse_timestamp(value):
+    """
+    Parse one of GitHub's ISO 8601 timestamps, eg 2016-07-11T22:14:10Z
+    """
+    # fromisoformat() only understands Z starting with Python 3.11
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        import dateutil.parser
+        return dateutil.parser.isoparse(value)
 
 
 class GithubBaseApp:
     # Lifespan of generated tokens
     LIFESPAN = 10 * 60  # 10min, documented maxmimum
+    # Regenerate tokens this long before they actually expire
+    REFRESH_MARGIN = 30
+    # How long to remember which installation an org/repo/user belongs to
+    INSTALLATION_CACHE_TTL = 60 * 60
+    INSTALLATION_CACHE_SIZE = 1024
+    # Reuse installation tokens until they're this close to expiring
+    INSTALLATION_TOKEN_MARGIN = 60
 
     _token = None
     _expiration = None
+    _headers_for_app = None
 
     def __init__(self, app_id, pem_data):
-        self.app_id = app_id
-        self.key = jwcrypto.jwk.JWK.from_pem(pem_data)
+        # PyJWT insists on a string issuer
+        self.app_id = str(app_id)
+        self.key = load_pem_private_key(pem_data, password=None)
+        self._installations = {}
+        self._installation_tokens = {}
+        self._installation_token_locks = {}
 
     @property
     def token(self):
@@ -24,20 +102,117 @@ class GithubBaseApp:
 
         This is per https://developer.github.com/apps/building-github-apps/authenticating-with-github-apps/
         """
-        now = time.time()
-        if self._token is None or self._expiration <= now:
+        self._refresh_token()
+        return self._token
+
+    @property
+    def _app_headers(self):
+        """
+        Base headers for calling GitHub as this app, with an up-to-date token.
+
+        Kept around so they don't have to be rebuilt for every request.
+        """
+        self._refresh_token()
+        return self._headers_for_app
+
+    def _refresh_token(self):
+        now = int(time.time())
+        if self._token is None or self._expiration - self.REFRESH_MARGIN <= now:
             self._expiration = now + self.LIFESPAN
-            jwt = jwcrypto.jwt.JWT(
-                header={
-                    "alg": "RS256",  # Hard coded
-                },
-                claims={
-                    "iat": int(now),
-                    "exp": int(self._expiration),
+            self._token = jwt.encode(
+                {
+                    "iat": now,
+                    "exp": self._expiration,
                     "iss": self.app_id,
                 },
+                self.key,
+                algorithm="RS256",
             )
-            jwt.make_signed_token(self.key)
-            self._token = jwt.serialize()
+            self._headers_for_app = {
+                'Accept': _build_accept('machine-man-preview'),
+                'Authorization': f"Bearer {self._token}",
+            }
 
-        return self._token
+    def _get_cached_installation(self, key):
+        """
+        Look up a remembered installation, or None if it's unknown or stale.
+
+        Returns a copy, so callers can't change what later lookups get.
+        """
+        try:
+            inst, expiration = self._installations[key]
+        except KeyError:
+            return None
+
+        if expiration <= time.time():
+            # Another thread may have gotten here first
+            self._installations.pop(key, None)
+            return None
+
+        return copy.deepcopy(inst)
+
+    def _cache_installation(self, key, inst):
+        """
+        Remember an installation for INSTALLATION_CACHE_TTL seconds.
+        """
+        self._installations.pop(key, None)
+        if len(self._installations) >= self.INSTALLATION_CACHE_SIZE:
+            # Dicts are ordered, so this is the oldest entry
+            self._installations.pop(next(iter(self._installations), None), None)
+        inst = copy.deepcopy(inst)
+        self._installations[key] = inst, time.time() + self.INSTALLATION_CACHE_TTL
+
+    def _forget_installation(self, installation_id):
+        """
+        Drop all remembered lookups and tokens of the given installation.
+        """
+        for key, (inst, _) in list(self._installations.items()):
+            if inst['id'] == installation_id:
+                self._installations.pop(key, None)
+        for key in list(self._installation_tokens):
+            if key[0] == installation_id:
+                self._installation_tokens.pop(key, None)
+
+    @staticmethod
+    def _installation_token_key(installation_id, permissions, repository_ids):
+        return (
+            installation_id,
+            frozenset(permissions.items()) if permissions else None,
+            tuple(repository_ids) if repository_ids else None,
+        )
+
+    def _get_cached_installation_token(self, key):
+        """
+        Look up a previously minted (token, expiration), or None if there isn't
+        one with at least INSTALLATION_TOKEN_MARGIN seconds left.
+        """
+        try:
+            token, expiration = self._installation_tokens[key]
+        except KeyError:
+            return None
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if (expiration - now).total_seconds() <= self.INSTALLATION_TOKEN_MARGIN:
+            self._installation_tokens.pop(key, None)
+            return None
+
+        return token, expiration
+
+    def _cache_installation_token(self, key, token, expiration):
+        """
+        Remember a minted token, bounded by INSTALLATION_CACHE_SIZE.
+        """
+        self._installation_tokens.pop(key, None)
+        if len(self._installation_tokens) >= self.INSTALLATION_CACHE_SIZE:
+            self._installation_tokens.pop(next(iter(self._installation_tokens), None), None)
+        self._installation_tokens[key] = token, expiration
+
+    def _drop_installation_token_lock(self, key, lock):
+        """
+        Locks are only needed while a mint is in flight, so don't keep them.
+
+        Must be called while holding lock, so that only one caller at a time
+        can find it still in place.
+        """
+        if self._installation_token_locks.get(key) is lock:
+            self._installation_token_locks.pop(key, None)
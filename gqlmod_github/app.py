@@ -5,51 +5,77 @@ This is basically a dramatically reduced v3 REST client focusing just on the app
 and installation features.
 """
 import contextlib
-import json
-import re
-from urllib.request import urlopen, Request
-import urllib.error
+import threading
 
-import dateutil.parser
 import gqlmod
+import requests
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 from . import _build_accept
-from ._app_base import GithubBaseApp
+from ._app_base import (
+    GithubAPIError, GithubBaseApp, _find_link, _json_dumps, _json_loads, _parse_timestamp,
+)
 
 
-# From https://github.com/psf/requests/blob/f5dacf84468ab7e0631cc61a3f1431a32e3e143c/requests/utils.py#L580-L611
-def parse_header_links(value):
-    """Return a dict of parsed link headers proxies.
+# Shared so that connections to api.github.com are kept alive between calls
+_SESSION = requests.Session()
 
-    i.e. Link: <http:/.../front.jpeg>; rel=front; type="image/jpeg",<http://.../back.jpeg>; rel=back;type="image/jpeg"
 
+def get_session():
     """
+    Returns the requests.Session used for all REST calls.
 
-    replace_chars = " '\""
-
-    for val in re.split(", *<", value):
-        try:
-            url, params = val.split(";", 1)
-        except ValueError:
-            url, params = val, ''
+    Mount adapters on it to tune connection pooling or retries.
+    """
+    return _SESSION
 
-        link = {}
-        link["url"] = url.strip("<> '\"")
 
-        for param in params.split(";"):
-            try:
-                key, value = param.split("=")
-            except ValueError:
-                break
+class GithubError(GithubAPIError, requests.HTTPError):
+    """
+    A GithubAPIError that's also a requests.HTTPError, carrying the request
+    and response.
+    """
+    def __init__(self, response):
+        requests.HTTPError.__init__(
+            self, f"{response.status_code} {response.reason}", response=response,
+        )
+        self.status = response.status_code
+        self.url = response.url
+        self.body = response.text
 
-            link[key.strip(replace_chars)] = value.strip(replace_chars)
 
-        yield link
+def _iter_items(resp):
+    """
+    Decode a JSON array response item by item, as it downloads (if ijson is
+    available).
+    """
+    with resp:
+        if ijson is None:
+            yield from _json_loads(resp.content)
+        else:
+            # Let urllib3 undo any Content-Encoding
+            resp.raw.decode_content = True
+            yield from ijson.items(resp.raw, 'item', use_float=True)
 
 
-def call_rest(method, url, *, body=None, preview=None, bearer=None):
+def call_rest(
+    method, url, *, body=None, preview=None, bearer=None, base_headers=None, stream=False,
+    expected=(200,),
+):
     """
     Performs an API request, in the form of GitHub v3 API.
+
+    base_headers are sent with the request, amended by the other arguments.
+
+    Raises GithubError if the response status isn't one of expected.
+
+    If stream is true, the response must be a JSON array, and the body is
+    produced as an iterator over its items, decoded as they arrive. It must be
+    exhausted before the connection can be reused.
     """
     # FIXME: Handle API request throttling
     if method == 'GET' and body:
@@ -58,10 +84,10 @@ def call_rest(method, url, *, body=None, preview=None, bearer=None):
     if url.startswith('/'):
         url = f"https://api.github.com{url}"
 
-    headers = {}
+    headers = dict(base_headers) if base_headers else {}
 
     if body:
-        data = json.dumps(body).encode('utf-8')
+        data = _json_dumps(body)
         headers['Content-Type'] = 'application/json'
     else:
         data = None
@@ -72,46 +98,38 @@ def call_rest(method, url, *, body=None, preview=None, bearer=None):
     if bearer:
         headers['Authorization'] = f"Bearer {bearer}"
 
-    req = Request(url, method=method, data=data, headers=headers)
+    resp = _SESSION.request(method, url, data=data, headers=headers, stream=stream)
 
-    try:
-        resp = urlopen(req)
-    except urllib.error.HTTPError as exc:
-        print(exc.read())  # FIXME: Actual log
-        raise
+    if resp.status_code not in expected:
+        raise GithubError(resp)
 
-    data = resp.read()
-    if data:
-        rbody = json.loads(data.decode('utf-8'))
+    if stream:
+        rbody = _iter_items(resp)
+    elif resp.content:
+        rbody = _json_loads(resp.content)
     else:
         rbody = None
 
-    return resp.getcode(), resp.info(), rbody
+    return resp.status_code, resp.headers, rbody
 
 
-def iter_pages(url, *, preview=None, bearer=None):
+def iter_pages(url, *, preview=None, bearer=None, base_headers=None, stream=False):
     """
     Run a request, and follow the "next" URL in the Link header, recursively.
 
     Note that only GET requests are supported due to the nature of pagination.
 
-    Produces 3-tuples of (code, info, body).
+    Produces 3-tuples of (code, info, body). See call_rest() for stream.
     """
     nextpage = url
     while nextpage:
-        code, info, body = call_rest('GET', url, preview=preview, bearer=bearer)
+        code, info, body = call_rest(
+            'GET', nextpage, preview=preview, bearer=bearer, base_headers=base_headers,
+            stream=stream,
+        )
         yield code, info, body
-        link_header = info.get('Link', None)
-        if not link_header:
-            break
 
-        links = {
-            link['rel']: link['url']
-            for link in parse_header_links(link_header)
-            if 'rel' in link
-        }
-
-        nextpage = links.get('next', None)
+        nextpage = _find_link(info.get('Link'), 'next')
 
 
 class GithubApp(GithubBaseApp):
@@ -120,17 +138,20 @@ class GithubApp(GithubBaseApp):
 
     Please note: Not thread safe.
     """
+    def _call_as_app(self, method, url, **kwargs):
+        """
+        call_rest() as this app, returning just the body.
+        """
+        code, headers, body = call_rest(method, url, base_headers=self._app_headers, **kwargs)
+        return body
+
     def get_app(self, slug):
         """
         Get the app information, by slug
 
         https://developer.github.com/v3/apps/#get-a-single-github-app
         """
-        code, headers, body = call_rest(
-            'GET', f'/apps/{slug}', bearer=self.token, preview='machine-man-preview'
-        )
-        assert code == 200
-        return body
+        return self._call_as_app('GET', f'/apps/{slug}')
 
     def get_this_app(self):
         """
@@ -138,24 +159,20 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#get-the-authenticated-github-app
         """
-        code, headers, body = call_rest(
-            'GET', '/app', bearer=self.token, preview='machine-man-preview',
-        )
-        assert code == 200
-        return body
+        return self._call_as_app('GET', '/app')
 
     def iter_installations(self):
         """
         Generate all installations.
 
-        Traverses pagination.
+        Traverses pagination. Installations are decoded as they arrive, instead
+        of a page at a time.
 
         https://developer.github.com/v3/apps/#list-installations
         """
         for code, info, page in iter_pages(
-            '/app/installations', bearer=self.token, preview='machine-man-preview',
+            '/app/installations', base_headers=self._app_headers, stream=True,
         ):
-            assert code == 200
             yield from page
 
     def get_installation(self, installation_id):
@@ -164,12 +181,7 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#get-an-installation
         """
-        code, headers, body = call_rest(
-            'GET', f'/app/installations/{installation_id}',
-            bearer=self.token, preview='machine-man-preview',
-        )
-        assert code == 200
-        return body
+        return self._call_as_app('GET', f'/app/installations/{installation_id}')
 
     def delete_installation(self, installation_id):
         """
@@ -177,11 +189,12 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#delete-an-installation
         """
-        code, headers, body = call_rest(
+        self._call_as_app(
             'DELETE', f'/app/installations/{installation_id}',
-            bearer=self.token, preview=['machine-man-preview', 'gambit-preview'],
+            preview=['machine-man-preview', 'gambit-preview'],
+            expected=(204,),
         )
-        assert code == 204
+        self._forget_installation(installation_id)
 
     def make_installation_token(self, installation_id, *, repository_ids=None, permissions=None):
         """
@@ -197,12 +210,10 @@ class GithubApp(GithubBaseApp):
             params['repository_ids'] = repository_ids
         if permissions:
             params['permissions'] = permissions
-        code, headers, body = call_rest(
+        return self._call_as_app(
             'POST', f'/app/installations/{installation_id}/access_tokens',
-            body=params, bearer=self.token, preview='machine-man-preview',
+            body=params, expected=(201,),
         )
-        assert code == 201
-        return body
 
     def get_org_installation(self, org):
         """
@@ -210,12 +221,12 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#get-an-organization-installation
         """
-        code, headers, body = call_rest(
-            'GET', f'/orgs/{org}/installation',
-            bearer=self.token, preview='machine-man-preview',
-        )
-        assert code == 200
-        return body
+        key = ('org', org.lower())
+        inst = self._get_cached_installation(key)
+        if inst is None:
+            inst = self._call_as_app('GET', f'/orgs/{org}/installation')
+            self._cache_installation(key, inst)
+        return inst
 
     def get_repo_installation(self, owner, repo):
         """
@@ -223,12 +234,12 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#get-a-repository-installation
         """
-        code, headers, body = call_rest(
-            'GET', f'/repos/{owner}/{repo}/installation',
-            bearer=self.token, preview='machine-man-preview',
-        )
-        assert code == 200
-        return body
+        key = ('repo', owner.lower(), repo.lower())
+        inst = self._get_cached_installation(key)
+        if inst is None:
+            inst = self._call_as_app('GET', f'/repos/{owner}/{repo}/installation')
+            self._cache_installation(key, inst)
+        return inst
 
     def get_user_installation(self, username):
         """
@@ -236,12 +247,12 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#get-a-user-installation
         """
-        code, headers, body = call_rest(
-            'GET', f'/users/{username}/installation',
-            bearer=self.token, preview='machine-man-preview',
-        )
-        assert code == 200
-        return body
+        key = ('user', username.lower())
+        inst = self._get_cached_installation(key)
+        if inst is None:
+            inst = self._call_as_app('GET', f'/users/{username}/installation')
+            self._cache_installation(key, inst)
+        return inst
 
     @staticmethod
     def create_app_from_manifest(code):
@@ -250,11 +261,11 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#create-a-github-app-from-a-manifest
         """
+        # Documented as 201, but this used to accept 200
         code, headers, body = call_rest(
             'POST', f'/app-manifests/{code}/conversions',
-            preview='fury-preview',
+            preview='fury-preview', expected=(200, 201),
         )
-        assert code == 200
         return body
 
     def token_for_repo(self, owner_or_repo, repo=None, *, repo_id=None, permissions=None):
@@ -265,7 +276,8 @@ class GithubApp(GithubBaseApp):
         Convenience shortcut to call get_repo_installation() and
         make_installation_token() in one go.
 
-        Returns the token and expiration datetime
+        Returns the token and expiration datetime. Tokens are reused across
+        calls until shortly before they expire.
 
         The permissions for the token may be passed in.
 
@@ -277,20 +289,48 @@ class GithubApp(GithubBaseApp):
         else:
             owner, repo = owner_or_repo, repo
 
-        inst = self.get_repo_installation(owner, repo)
-
         if repo_id is None:
             repository_ids = None
         else:
             repository_ids = [repo_id]
 
-        token = self.make_installation_token(
-            inst['id'], permissions=permissions, repository_ids=repository_ids,
-        )
+        inst = self.get_repo_installation(owner, repo)
+        try:
+            return self._installation_token(inst['id'], permissions, repository_ids)
+        except GithubAPIError as exc:
+            if exc.status != 404:
+                raise
 
-        t = token['token']
-        exp = dateutil.parser.isoparse(token['expires_at'])
-        return t, exp
+        # The remembered installation may be gone, eg if the app was reinstalled
+        self._forget_installation(inst['id'])
+        inst = self.get_repo_installation(owner, repo)
+        return self._installation_token(inst['id'], permissions, repository_ids)
+
+    def _installation_token(self, installation_id, permissions, repository_ids):
+        """
+        make_installation_token(), reusing tokens for identical requests.
+
+        Returns the token and expiration datetime.
+        """
+        # Tokens are good for an hour, so reuse them for identical requests
+        key = self._installation_token_key(installation_id, permissions, repository_ids)
+        lock = self._installation_token_locks.setdefault(key, threading.Lock())
+        with lock:
+            try:
+                cached = self._get_cached_installation_token(key)
+                if cached is not None:
+                    return cached
+
+                token = self.make_installation_token(
+                    installation_id, permissions=permissions, repository_ids=repository_ids,
+                )
+
+                t = token['token']
+                exp = _parse_timestamp(token['expires_at'])
+                self._cache_installation_token(key, t, exp)
+                return t, exp
+            finally:
+                self._drop_installation_token_lock(key, lock)
 
     @contextlib.contextmanager
     def for_app(self):
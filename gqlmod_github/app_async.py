@@ -4,34 +4,70 @@ Utilities for acting as an app and dealing with installations.
 This is basically a dramatically reduced v3 REST client focusing just on the app
 and installation features.
 """
+import asyncio
 import contextlib
 import logging
-import json
+import urllib.parse
 
-import aiohttp
-import dateutil.parser
 import gqlmod
+import httpx
 
 from . import _build_accept
-from ._app_base import GithubBaseApp
+from ._app_base import (
+    GithubAPIError, GithubBaseApp, _find_link, _json_dumps, _json_loads, _parse_timestamp,
+)
 
 log = logging.getLogger(__name__)
 
 
-class GithubError(aiohttp.ClientResponseError):
-    def __init__(self, *p, body, **kw):
-        super().__init__(*p, **kw)
-        self.body = body
-
-    def __str__(self) -> str:
-        return ("%s, message=%r, url=%r\n%s" %
-                (self.status, self.message, self.request_info.real_url, self.body))
+class GithubError(GithubAPIError, httpx.HTTPStatusError):
+    """
+    A GithubAPIError that's also an httpx.HTTPStatusError, carrying the
+    request and response.
+    """
+    def __init__(self, response):
+        httpx.HTTPStatusError.__init__(
+            self, response.reason_phrase, request=response.request, response=response,
+        )
+        self.status = response.status_code
+        self.url = str(response.url)
+        self.body = response.text
 
 
-@contextlib.asynccontextmanager
-async def call_rest(method, url, *, body=None, preview=None, bearer=None):
+def _make_client():
+    """
+    Makes an httpx.AsyncClient set up for calling GitHub.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        # GitHub redirects for renamed and transferred repos
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=10),
+        timeout=30,
+        headers={
+            'Accept': 'application/vnd.github.v3+json',
+            'User-Agent': 'gqlmod-github',
+        },
+    )
+
+
+async def call_rest(
+    method, url, *, body=None, preview=None, bearer=None, base_headers=None, session=None,
+    expected=(200,),
+):
     """
     Performs an API request, in the form of GitHub v3 API.
+
+    base_headers are sent with the request, amended by the other arguments.
+
+    Raises GithubError if the response status isn't one of expected.
+
+    If a session (an httpx.AsyncClient) is given, it is used to make the
+    request, allowing connections to be reused. Otherwise, a one-off client is
+    used.
+
+    Returns a 3-tuple of (code, headers, body). The body is read and decoded
+    before returning, so the connection goes straight back to the pool.
     """
     # FIXME: Handle API request throttling
     if method == 'GET' and body:
@@ -40,10 +76,10 @@ async def call_rest(method, url, *, body=None, preview=None, bearer=None):
     if url.startswith('/'):
         url = f"https://api.github.com{url}"
 
-    headers = {}
+    headers = dict(base_headers) if base_headers else {}
 
     if body:
-        data = json.dumps(body).encode('utf-8')
+        data = _json_dumps(body)
         headers['Content-Type'] = 'application/json'
     else:
         data = None
@@ -55,36 +91,97 @@ async def call_rest(method, url, *, body=None, preview=None, bearer=None):
         headers['Authorization'] = f"Bearer {bearer}"
 
     log.debug("Calling %s %r", method, url)
-    async with aiohttp.request(method, url, headers=headers, data=data) as resp:
-        if 400 <= resp.status:
-            raise GithubError(
-                resp.request_info,
-                resp.history,
-                status=resp.status,
-                message=resp.reason,
-                headers=resp.headers,
-                body=await resp.text(),
-            )
-        yield resp
+    if session is None:
+        async with _make_client() as client:
+            resp = await client.request(method, url, headers=headers, content=data)
+    else:
+        resp = await session.request(method, url, headers=headers, content=data)
+
+    if resp.status_code not in expected:
+        raise GithubError(resp)
+
+    if resp.content:
+        rbody = _json_loads(resp.content)
+    else:
+        rbody = None
+
+    return resp.status_code, resp.headers, rbody
 
 
-async def iter_pages(url, *, preview=None, bearer=None):
+async def iter_pages(
+    url, *, preview=None, bearer=None, base_headers=None, session=None, prefetch=2,
+):
     """
     Run a request, and follow the "next" URL in the Link header, recursively.
 
     Note that only GET requests are supported due to the nature of pagination.
 
+    Up to prefetch pages are requested ahead of the consumer, so the network
+    and the processing of earlier pages overlap.
+
     Produces 3-tuples of (code, info, body).
     """
-    nextpage = url
-    while nextpage:
-        async with call_rest('GET', nextpage, preview=preview, bearer=bearer) as resp:
-            yield resp
+    if prefetch < 1:
+        # A queue without a size would prefetch everything
+        raise ValueError("prefetch must be at least 1")
+
+    queue = asyncio.Queue(maxsize=prefetch)
+
+    async def produce():
+        nextpage = url
+        try:
+            while nextpage:
+                page = await call_rest(
+                    'GET', nextpage, preview=preview, bearer=bearer,
+                    base_headers=base_headers, session=session,
+                )
+                await queue.put(page)
+                nextpage = _find_link(page[1].get('Link'), 'next')
+        except asyncio.CancelledError:
+            # Only an Exception before Python 3.8
+            raise
+        except Exception as exc:
+            await queue.put(exc)
+        else:
+            await queue.put(None)
 
-            if 'next' not in resp.links:
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            page = await queue.get()
+            if page is None:
                 break
+            elif isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        producer.cancel()
+
+
+def _page_urls(last):
+    """
+    Produce the URLs of pages 2 through N, given the URL of page N.
+    """
+    parts = urllib.parse.urlsplit(last)
+    query = urllib.parse.parse_qs(parts.query)
+    for page in range(2, int(query['page'][0]) + 1):
+        query['page'] = [str(page)]
+        yield parts._replace(query=urllib.parse.urlencode(query, doseq=True)).geturl()
 
-            nextpage = str(resp.links['next']['url'])
+
+async def _gather_bounded(aws, limit=8):
+    """
+    Like asyncio.gather(), but runs at most limit of the awaitables at once.
+
+    Used to stay clear of GitHub's secondary rate limits.
+    """
+    sem = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with sem:
+            return await aw
+
+    return await asyncio.gather(*(run(aw) for aw in aws))
 
 
 class GithubApp(GithubBaseApp):
@@ -92,17 +189,48 @@ class GithubApp(GithubBaseApp):
     Your Github Application
 
     Please note: Not thread safe.
+
+    Requests share a single HTTP/2 session, which should be closed when done,
+    either with close() or by using the app as an async context manager.
     """
+    _session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.is_closed:
+            self._session = _make_client()
+        return self._session
+
+    async def close(self):
+        """
+        Close the underlying HTTP session.
+        """
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _call_as_app(self, method, url, **kwargs):
+        """
+        call_rest() as this app, returning just the body.
+        """
+        code, headers, body = await call_rest(
+            method, url, base_headers=self._app_headers, session=self._get_session(),
+            **kwargs,
+        )
+        return body
+
     async def get_app(self, slug):
         """
         Get the app information, by slug
 
         https://developer.github.com/v3/apps/#get-a-single-github-app
         """
-        async with call_rest(
-            'GET', f'/apps/{slug}', bearer=self.token, preview='machine-man-preview'
-        ) as resp:
-            return await resp.json(content_type=False)
+        return await self._call_as_app('GET', f'/apps/{slug}')
 
     async def get_this_app(self):
         """
@@ -110,24 +238,51 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#get-the-authenticated-github-app
         """
-        async with call_rest(
-            'GET', '/app', bearer=self.token, preview='machine-man-preview',
-        ) as resp:
-            return await resp.json(content_type=False)
+        return await self._call_as_app('GET', '/app')
 
     async def iter_installations(self):
         """
         Generate all installations.
 
-        Traverses pagination.
+        Traverses pagination. Once the first page reveals the number of pages,
+        the rest are fetched concurrently.
 
         https://developer.github.com/v3/apps/#list-installations
         """
-        async for resp in iter_pages(
-            '/app/installations', bearer=self.token, preview='machine-man-preview',
-        ):
-            for inst in await resp.json(content_type=False):
+        kwargs = {
+            'base_headers': self._app_headers,
+            'session': self._get_session(),
+        }
+        code, info, first = await call_rest('GET', '/app/installations', **kwargs)
+        last = _find_link(info.get('Link'), 'last')
+
+        if last is None:
+            for inst in first:
+                yield inst
+            nextpage = _find_link(info.get('Link'), 'next')
+            if nextpage is not None:
+                # Can't tell how many pages there are, so walk them
+                async for code, info, page in iter_pages(nextpage, **kwargs):
+                    for inst in page:
+                        yield inst
+            return
+
+        rest = asyncio.ensure_future(_gather_bounded(
+            call_rest('GET', url, **kwargs)
+            for url in _page_urls(last)
+        ))
+        try:
+            for inst in first:
                 yield inst
+            for code, info, page in await rest:
+                for inst in page:
+                    yield inst
+        finally:
+            if not rest.done():
+                rest.cancel()
+            elif not rest.cancelled():
+                # Mark a failure as seen, since it's not getting raised
+                rest.exception()
 
     async def get_installation(self, installation_id):
         """
@@ -135,11 +290,7 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#get-an-installation
         """
-        async with await call_rest(
-            'GET', f'/app/installations/{installation_id}',
-            bearer=self.token, preview='machine-man-preview',
-        ) as resp:
-            return await resp.json(content_type=False)
+        return await self._call_as_app('GET', f'/app/installations/{installation_id}')
 
     async def delete_installation(self, installation_id):
         """
@@ -147,11 +298,12 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#delete-an-installation
         """
-        async with await call_rest(
+        await self._call_as_app(
             'DELETE', f'/app/installations/{installation_id}',
-            bearer=self.token, preview=['machine-man-preview', 'gambit-preview'],
-        ) as resp:
-            assert resp.status == 204
+            preview=['machine-man-preview', 'gambit-preview'],
+            expected=(204,),
+        )
+        self._forget_installation(installation_id)
 
     async def make_installation_token(self, installation_id, *, repository_ids=None, permissions=None):
         """
@@ -167,12 +319,10 @@ class GithubApp(GithubBaseApp):
             params['repository_ids'] = repository_ids
         if permissions:
             params['permissions'] = permissions
-        async with call_rest(
+        return await self._call_as_app(
             'POST', f'/app/installations/{installation_id}/access_tokens',
-            body=params, bearer=self.token, preview='machine-man-preview',
-        ) as resp:
-            assert resp.status == 201
-            return await resp.json(content_type=False)
+            body=params, expected=(201,),
+        )
 
     async def get_org_installation(self, org):
         """
@@ -180,12 +330,12 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#get-an-organization-installation
         """
-        async with call_rest(
-            'GET', f'/orgs/{org}/installation',
-            bearer=self.token, preview='machine-man-preview',
-        ) as resp:
-            assert resp.status == 200
-            return await resp.json(content_type=False)
+        key = ('org', org.lower())
+        inst = self._get_cached_installation(key)
+        if inst is None:
+            inst = await self._call_as_app('GET', f'/orgs/{org}/installation')
+            self._cache_installation(key, inst)
+        return inst
 
     async def get_repo_installation(self, owner, repo):
         """
@@ -193,12 +343,12 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#get-a-repository-installation
         """
-        async with call_rest(
-            'GET', f'/repos/{owner}/{repo}/installation',
-            bearer=self.token, preview='machine-man-preview',
-        ) as resp:
-            assert resp.status == 200
-            return await resp.json(content_type=False)
+        key = ('repo', owner.lower(), repo.lower())
+        inst = self._get_cached_installation(key)
+        if inst is None:
+            inst = await self._call_as_app('GET', f'/repos/{owner}/{repo}/installation')
+            self._cache_installation(key, inst)
+        return inst
 
     async def get_user_installation(self, username):
         """
@@ -206,12 +356,12 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#get-a-user-installation
         """
-        async with call_rest(
-            'GET', f'/users/{username}/installation',
-            bearer=self.token, preview='machine-man-preview',
-        ) as resp:
-            assert resp.status == 200
-            return await resp.json(content_type=False)
+        key = ('user', username.lower())
+        inst = self._get_cached_installation(key)
+        if inst is None:
+            inst = await self._call_as_app('GET', f'/users/{username}/installation')
+            self._cache_installation(key, inst)
+        return inst
 
     @staticmethod
     async def create_app_from_manifest(code):
@@ -220,12 +370,12 @@ class GithubApp(GithubBaseApp):
 
         https://developer.github.com/v3/apps/#create-a-github-app-from-a-manifest
         """
-        async with call_rest(
+        # Documented as 201, but this used to accept 200
+        code, headers, body = await call_rest(
             'POST', f'/app-manifests/{code}/conversions',
-            preview='fury-preview',
-        ) as resp:
-            assert resp.status == 200
-            return await resp.json(content_type=False)
+            preview='fury-preview', expected=(200, 201),
+        )
+        return body
 
     async def token_for_repo(self, owner_or_repo, repo=None, *, repo_id=None, permissions=None):
         """
@@ -235,7 +385,8 @@ class GithubApp(GithubBaseApp):
         Convenience shortcut to call get_repo_installation() and
         make_installation_token() in one go.
 
-        Returns the token and expiration datetime
+        Returns the token and expiration datetime. Tokens are reused across
+        calls until shortly before they expire.
 
         The permissions for the token may be passed in.
 
@@ -247,29 +398,76 @@ class GithubApp(GithubBaseApp):
         else:
             owner, repo = owner_or_repo, repo
 
-        inst = await self.get_repo_installation(owner, repo)
-
         if repo_id is None:
             repository_ids = None
         else:
             repository_ids = [repo_id]
 
-        token = await self.make_installation_token(
-            inst['id'], permissions=permissions, repository_ids=repository_ids,
-        )
+        inst = await self.get_repo_installation(owner, repo)
+        try:
+            return await self._installation_token(inst['id'], permissions, repository_ids)
+        except GithubAPIError as exc:
+            if exc.status != 404:
+                raise
+
+        # The remembered installation may be gone, eg if the app was reinstalled
+        self._forget_installation(inst['id'])
+        inst = await self.get_repo_installation(owner, repo)
+        return await self._installation_token(inst['id'], permissions, repository_ids)
+
+    async def _installation_token(self, installation_id, permissions, repository_ids):
+        """
+        make_installation_token(), reusing tokens for identical requests.
+
+        Returns the token and expiration datetime.
+        """
+        # Tokens are good for an hour, so reuse them for identical requests
+        key = self._installation_token_key(installation_id, permissions, repository_ids)
+        lock = self._installation_token_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            try:
+                cached = self._get_cached_installation_token(key)
+                if cached is not None:
+                    return cached
+
+                token = await self.make_installation_token(
+                    installation_id, permissions=permissions, repository_ids=repository_ids,
+                )
+
+                t = token['token']
+                exp = _parse_timestamp(token['expires_at'])
+                self._cache_installation_token(key, t, exp)
+                return t, exp
+            finally:
+                self._drop_installation_token_lock(key, lock)
+
+    async def tokens_for_repos(self, repos, *, permissions=None):
+        """
+        ga.tokens_for_repos(["owner/repo", ("owner", "repo")]) -> list
+
+        Calls token_for_repo() for many repositories concurrently (a few at a
+        time, to stay clear of GitHub's abuse limits).
 
-        t = token['token']
-        exp = dateutil.parser.isoparse(token['expires_at'])
-        return t, exp
+        Returns a list of (token, expiration datetime), in the order of repos.
 
-    @contextlib.contextmanager
-    def for_app(self):
+        The permissions for the tokens may be passed in.
+        """
+        return await _gather_bounded(
+            self.token_for_repo(
+                *((repo,) if isinstance(repo, str) else repo), permissions=permissions,
+            )
+            for repo in repos
+        )
+
+    @contextlib.asynccontextmanager
+    async def for_app(self):
         """
         Convenience shortcut to make this app the current github credentials.
         """
         # FIXME: What if it expires?
-        with gqlmod.with_provider('github-async', token=self.token):
-            yield
+        token = self.token
+        with gqlmod.with_provider('github-async', token=token):
+            yield token
 
     @contextlib.asynccontextmanager
     async def for_repo(self, *pargs, **kwargs):
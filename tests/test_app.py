@@ -0,0 +1,623 @@
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import gc
+import gzip
+import http.server
+import json
+import os
+import sys
+import threading
+import urllib.parse
+
+import httpx
+import jwt
+import pytest
+import requests
+import requests.adapters
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from gqlmod_github import app, app_async
+from gqlmod_github._app_base import GithubAPIError, _find_link, _parse_timestamp
+
+
+def make_response(status, body=None, headers=None, url=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.url = url
+    resp.headers.update(headers or {})
+    resp._content = b'' if body is None else json.dumps(body).encode('utf-8')
+    return resp
+
+
+@pytest.fixture(scope='module')
+def pem():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """
+    Replaces the sync call_rest() with one answering installation lookups.
+
+    Records the (method, url) of each call.
+    """
+    calls = []
+
+    def call_rest(method, url, **kwargs):
+        calls.append((method, url))
+        if method == 'DELETE':
+            return 204, {}, None
+        elif method == 'POST':
+            expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+            return 201, {}, {
+                'token': f'token{len(calls)}',
+                'expires_at': expires.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            }
+        return 200, {}, {'id': len(url), 'account': {'login': url}}
+
+    monkeypatch.setattr(app, 'call_rest', call_rest)
+    return calls
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """
+    Routes the async client's requests to api.handler, a function taking an
+    httpx.Request and returning an httpx.Response (or a coroutine of one).
+    """
+    class Api:
+        handler = None
+
+    mock = Api()
+    transport = httpx.MockTransport(lambda request: mock.handler(request))
+    monkeypatch.setattr(
+        httpx, 'AsyncClient', functools.partial(httpx.AsyncClient, transport=transport),
+    )
+    return mock
+
+
+@pytest.fixture
+def rest(monkeypatch):
+    """
+    Replaces the sync session's requests with a canned response for each URL.
+
+    Set rest.responses[url] and check rest.calls.
+    """
+    class Rest:
+        def __init__(self):
+            self.responses = {}
+            self.calls = []
+
+        def request(self, method, url, **kwargs):
+            self.calls.append((method, url))
+            return self.responses[url]
+
+    mock = Rest()
+    monkeypatch.setattr(app._SESSION, 'request', mock.request)
+    return mock
+
+
+LINKS = (
+    '<https://api.github.com/app/installations?page=2>; rel="next", '
+    '<https://api.github.com/app/installations?page=5>; rel="last"'
+)
+
+
+@pytest.mark.parametrize('value,rel,url', [
+    (LINKS, 'next', 'https://api.github.com/app/installations?page=2'),
+    (LINKS, 'last', 'https://api.github.com/app/installations?page=5'),
+    (LINKS, 'prev', None),
+    ('', 'next', None),
+    (None, 'next', None),
+])
+def test_find_link(value, rel, url):
+    assert _find_link(value, rel) == url
+
+
+@pytest.mark.parametrize('value', [
+    '2016-07-11T22:14:10Z',
+    '2016-07-11T22:14:10+00:00',
+    '2016-07-11T22:14:10.000Z',
+])
+def test_parse_timestamp(value):
+    assert _parse_timestamp(value) == datetime.datetime(
+        2016, 7, 11, 22, 14, 10, tzinfo=datetime.timezone.utc,
+    )
+
+
+def test_iter_pages_follows_next(rest):
+    for page in (1, 2, 3):
+        headers = {}
+        if page < 3:
+            headers['Link'] = (
+                f'<https://api.github.com/items?page={page + 1}>; rel="next", '
+                '<https://api.github.com/items?page=3>; rel="last"'
+            )
+        url = 'https://api.github.com/items' + (f'?page={page}' if page > 1 else '')
+        rest.responses[url] = make_response(200, [page], headers)
+
+    pages = [body for code, info, body in app.iter_pages('/items')]
+
+    assert pages == [[1], [2], [3]]
+    assert rest.calls == [
+        ('GET', 'https://api.github.com/items'),
+        ('GET', 'https://api.github.com/items?page=2'),
+        ('GET', 'https://api.github.com/items?page=3'),
+    ]
+
+
+@pytest.fixture
+def local_api(monkeypatch):
+    """
+    Sends the sync session's api.github.com requests to a local server, which
+    answers with gzipped pages 1 through 3 of 10000 installations each (too
+    many to be read in one go).
+
+    The responses are recorded in local_api.responses.
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            page = int(query.get('page', ['1'])[0])
+            body = gzip.compress(json.dumps(
+                [
+                    {'id': page * 10000 + i, 'node_id': os.urandom(16).hex(), 'score': page + 0.5}
+                    for i in range(10000)
+                ]
+            ).encode('utf-8'))
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            if page < 3:
+                self.send_header(
+                    'Link', f'<https://api.github.com/app/installations?page={page + 1}>; rel="next"',
+                )
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    local = f'http://127.0.0.1:{server.server_port}'
+
+    class LocalAdapter(requests.adapters.HTTPAdapter):
+        responses = []
+
+        def send(self, request, **kwargs):
+            request.url = request.url.replace('https://api.github.com', local)
+            resp = super().send(request, **kwargs)
+            self.responses.append(resp)
+            return resp
+
+    session = app.get_session()
+    monkeypatch.setattr(session, 'adapters', session.adapters.copy())
+    adapter = LocalAdapter()
+    session.mount('https://api.github.com/', adapter)
+    yield adapter
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('streaming', [True, False])
+def test_iter_installations_streams(pem, local_api, monkeypatch, streaming):
+    if streaming:
+        pytest.importorskip('ijson')
+    else:
+        monkeypatch.setattr(app, 'ijson', None)
+    ga = app.GithubApp(1, pem)
+
+    insts = list(ga.iter_installations())
+
+    assert [inst['id'] for inst in insts] == list(range(10000, 40000))
+    assert {inst['score'] for inst in insts} == {1.5, 2.5, 3.5}
+    assert all(type(inst['score']) is float for inst in insts)
+    assert len(local_api.responses) == 3
+    assert all(resp.raw.closed for resp in local_api.responses)
+
+    insts = ga.iter_installations()
+    next(insts)
+    insts.close()
+    assert local_api.responses[3].raw.closed
+
+
+def test_installation_lookups_are_cached(pem, calls):
+    ga = app.GithubApp(1, pem)
+    inst = ga.get_repo_installation('Owner', 'Repo')
+    inst['account']['login'] = 'changed'
+
+    assert ga.get_repo_installation('owner', 'repo')['account']['login'] != 'changed'
+    assert calls == [('GET', '/repos/Owner/Repo/installation')]
+
+
+def test_installation_lookups_expire(pem, calls):
+    ga = app.GithubApp(1, pem)
+    ga.INSTALLATION_CACHE_TTL = 0
+    ga.get_org_installation('org')
+    ga.get_org_installation('org')
+
+    assert len(calls) == 2
+
+
+def test_installation_lookups_evict_oldest(pem, calls):
+    ga = app.GithubApp(1, pem)
+    ga.INSTALLATION_CACHE_SIZE = 2
+    for user in ('a', 'b', 'c', 'c', 'a'):
+        ga.get_user_installation(user)
+
+    assert [url for method, url in calls] == [
+        '/users/a/installation',
+        '/users/b/installation',
+        '/users/c/installation',
+        '/users/a/installation',
+    ]
+
+
+def test_delete_installation_forgets_lookups(pem, calls):
+    ga = app.GithubApp(1, pem)
+    inst = ga.get_org_installation('org')
+    ga.delete_installation(inst['id'])
+    ga.get_org_installation('org')
+
+    assert [method for method, url in calls] == ['GET', 'DELETE', 'GET']
+
+
+def test_installation_tokens_are_reused(pem, calls):
+    ga = app.GithubApp(1, pem)
+    token, exp = ga.token_for_repo('owner/repo')
+
+    assert ga.token_for_repo('owner', 'repo') == (token, exp)
+    assert [method for method, url in calls] == ['GET', 'POST']
+    assert not ga._installation_token_locks
+
+    ga.delete_installation(ga.get_repo_installation('owner', 'repo')['id'])
+    assert ga.token_for_repo('owner/repo')[0] != token
+    assert [method for method, url in calls] == ['GET', 'POST', 'DELETE', 'GET', 'POST']
+
+
+def test_installation_tokens_across_threads(pem, calls):
+    ga = app.GithubApp(1, pem)
+    # Have lookups expire underneath the threads too
+    ga.INSTALLATION_CACHE_TTL = 0
+    start = threading.Barrier(8)
+
+    def run():
+        start.wait()
+        return {ga.token_for_repo('owner/repo') for _ in range(5000)}
+
+    # Switch threads as often as possible, to shake out races
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            tokens = set().union(*pool.map(lambda _: run(), range(8)))
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert len(tokens) == 1
+    assert [method for method, url in calls].count('POST') == 1
+    assert not ga._installation_token_locks
+
+
+def test_reinstalled_app_gets_new_installation(pem, monkeypatch):
+    installation_ids = iter([1, 2])
+    calls = []
+
+    def call_rest(method, url, **kwargs):
+        calls.append((method, url))
+        if method == 'GET':
+            return 200, {}, {'id': next(installation_ids)}
+        elif url == '/app/installations/1/access_tokens':
+            raise GithubAPIError(404, url, 'Not Found')
+        return 201, {}, {'token': 'token', 'expires_at': '2099-01-01T00:00:00Z'}
+
+    monkeypatch.setattr(app, 'call_rest', call_rest)
+    ga = app.GithubApp(1, pem)
+
+    assert ga.token_for_repo('owner/repo')[0] == 'token'
+    assert calls == [
+        ('GET', '/repos/owner/repo/installation'),
+        ('POST', '/app/installations/1/access_tokens'),
+        ('GET', '/repos/owner/repo/installation'),
+        ('POST', '/app/installations/2/access_tokens'),
+    ]
+    assert ga.get_repo_installation('owner', 'repo') == {'id': 2}
+
+
+def test_token_with_int_app_id(pem):
+    ga = app.GithubApp(1234, pem)
+    claims = jwt.decode(ga.token, ga.key.public_key(), algorithms=['RS256'])
+
+    assert claims['iss'] == '1234'
+    assert claims['exp'] - claims['iat'] == ga.LIFESPAN
+    assert ga.token == ga.token
+
+
+@pytest.mark.asyncio
+async def test_repo_installation_follows_redirects(pem, api):
+    def handler(request):
+        if request.url.path == '/repos/old/name/installation':
+            return httpx.Response(
+                301, json={'message': 'Moved Permanently'},
+                headers={'Location': 'https://api.github.com/repositories/42/installation'},
+            )
+        assert request.headers['Authorization'].startswith('Bearer ')
+        return httpx.Response(200, json={'id': 42})
+
+    api.handler = handler
+    async with app_async.GithubApp(1, pem) as ga:
+        assert await ga.get_repo_installation('old', 'name') == {'id': 42}
+
+
+@pytest.mark.asyncio
+async def test_one_off_client_matches_session(pem, api):
+    sent = []
+
+    def handler(request):
+        sent.append(request)
+        return httpx.Response(200, json={})
+
+    api.handler = handler
+    await app_async.call_rest('GET', '/app')
+    async with app_async.GithubApp(1, pem) as ga:
+        await ga.get_this_app()
+
+    one_off, session = sent
+    assert one_off.extensions['timeout'] == session.extensions['timeout']
+    assert one_off.extensions['timeout']['read'] == 30
+    assert one_off.headers['User-Agent'] == session.headers['User-Agent'] == 'gqlmod-github'
+
+
+@pytest.mark.asyncio
+async def test_tokens_for_repos(pem, api):
+    posts = []
+
+    async def handler(request):
+        parts = request.url.path.split('/')
+        if request.method == 'POST':
+            posts.append(request.url.path)
+            # Give other lookups a chance to pile up behind the mint
+            await asyncio.sleep(0.01)
+            return httpx.Response(201, json={
+                'token': f'token{parts[3]}', 'expires_at': '2099-01-01T00:00:00Z',
+            })
+        # Repositories of the same owner share an installation
+        return httpx.Response(200, json={'id': int(parts[2][len('owner'):])})
+
+    api.handler = handler
+    async with app_async.GithubApp(1, pem) as ga:
+        tokens = await ga.tokens_for_repos(
+            ['owner1/a', ('owner2', 'b'), 'owner1/c', ('owner1', 'd')],
+        )
+
+    assert [token for token, exp in tokens] == ['token1', 'token2', 'token1', 'token1']
+    assert sorted(posts) == [
+        '/app/installations/1/access_tokens',
+        '/app/installations/2/access_tokens',
+    ]
+
+
+def paged(last, *, fail=None, stall=None):
+    """
+    Produces an async handler serving pages 1 through last of /items.
+
+    Page fail answers with a 500, and page stall never answers. Requested pages
+    are recorded in handler.requested, cancelled ones in handler.cancelled.
+    """
+    async def handler(request):
+        page = int(request.url.params.get('page', 1))
+        handler.requested.append(page)
+        if page == fail:
+            return httpx.Response(500, text='boom')
+        elif page == stall:
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                handler.cancelled.append(page)
+                raise
+
+        headers = {}
+        if page < last:
+            headers['Link'] = f'<https://api.github.com/items?page={page + 1}>; rel="next"'
+        return httpx.Response(200, json=[page], headers=headers)
+
+    handler.requested = []
+    handler.cancelled = []
+    return handler
+
+
+@pytest.mark.asyncio
+async def test_async_iter_pages_in_order(api):
+    api.handler = paged(5)
+    async with httpx.AsyncClient() as session:
+        pages = [
+            body
+            async for code, info, body in app_async.iter_pages('/items', session=session)
+        ]
+
+    assert pages == [[1], [2], [3], [4], [5]]
+    assert api.handler.requested == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.asyncio
+async def test_async_iter_pages_raises_producer_errors(api):
+    api.handler = paged(5, fail=3)
+    pages = []
+    async with httpx.AsyncClient() as session:
+        with pytest.raises(GithubAPIError):
+            async for code, info, body in app_async.iter_pages('/items', session=session):
+                pages.append(body)
+
+    assert pages == [[1], [2]]
+
+
+@pytest.mark.asyncio
+async def test_async_iter_pages_close_cancels_producer(api):
+    api.handler = paged(5, stall=2)
+    async with httpx.AsyncClient() as session:
+        pages = app_async.iter_pages('/items', session=session)
+        assert (await pages.__anext__())[2] == [1]
+        while 2 not in api.handler.requested:
+            await asyncio.sleep(0)
+        await pages.aclose()
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    assert api.handler.cancelled == [2]
+
+
+@pytest.mark.asyncio
+async def test_async_iter_pages_rejects_no_prefetch():
+    with pytest.raises(ValueError):
+        await app_async.iter_pages('/items', prefetch=0).__anext__()
+
+
+def installations(last, *, links=True, stall=None):
+    """
+    Produces an async handler serving pages 1 through last of installations,
+    with per_page=2.
+
+    Without links, pages only point at the next one, not the last. Page stall
+    never answers. Requested pages are recorded in handler.requested, cancelled
+    ones in handler.cancelled.
+    """
+    async def handler(request):
+        page = int(request.url.params.get('page', 1))
+        handler.requested.append((page, request.url.params.get('per_page')))
+        if page == stall:
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                handler.cancelled.append(page)
+                raise
+        elif page > 1:
+            # Make later pages finish first
+            await asyncio.sleep(0.01 * (last - page))
+
+        url = 'https://api.github.com/app/installations?per_page=2'
+        links = []
+        if page < last:
+            links.append(f'<{url}&page={page + 1}>; rel="next"')
+            if handler.links:
+                links.append(f'<{url}&page={last}>; rel="last"')
+        return httpx.Response(
+            200, json=[{'id': page * 10}, {'id': page * 10 + 1}],
+            headers={'Link': ', '.join(links)} if links else {},
+        )
+
+    handler.links = links
+    handler.requested = []
+    handler.cancelled = []
+    return handler
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('links', [True, False])
+async def test_async_iter_installations(pem, api, links):
+    api.handler = installations(4, links=links)
+    async with app_async.GithubApp(1, pem) as ga:
+        ids = [inst['id'] async for inst in ga.iter_installations()]
+
+    assert ids == [10, 11, 20, 21, 30, 31, 40, 41]
+    assert sorted(api.handler.requested) == [(1, None), (2, '2'), (3, '2'), (4, '2')]
+
+
+@pytest.mark.asyncio
+async def test_async_iter_installations_close_cancels_pages(pem, api):
+    api.handler = installations(4, stall=3)
+    async with app_async.GithubApp(1, pem) as ga:
+        insts = ga.iter_installations()
+        assert (await insts.__anext__())['id'] == 10
+        while len(api.handler.requested) < 4:
+            await asyncio.sleep(0)
+        await insts.aclose()
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    assert api.handler.cancelled == [3]
+
+
+@pytest.mark.asyncio
+async def test_async_iter_installations_close_after_failure(pem, api):
+    def handler(request):
+        if 'page' in request.url.params:
+            return httpx.Response(500, text='boom')
+        return installations(4)(request)
+
+    unhandled = []
+    asyncio.get_running_loop().set_exception_handler(lambda loop, ctx: unhandled.append(ctx))
+    api.handler = handler
+    async with app_async.GithubApp(1, pem) as ga:
+        insts = ga.iter_installations()
+        assert (await insts.__anext__())['id'] == 10
+        for _ in range(5):
+            await asyncio.sleep(0)
+        await insts.aclose()
+    del insts
+    gc.collect()
+
+    assert unhandled == []
+
+
+def test_unexpected_status_raises(rest):
+    url = 'https://api.github.com/app'
+    rest.responses[url] = make_response(404, {'message': 'Not Found'}, url=url)
+
+    with pytest.raises(GithubAPIError) as info:
+        app.call_rest('GET', '/app')
+
+    assert isinstance(info.value, requests.HTTPError)
+    assert info.value.status == 404
+    assert info.value.url == url
+    assert 'Not Found' in info.value.body
+
+
+@pytest.mark.parametrize('method,status', [('POST', 201), ('DELETE', 204)])
+def test_expected_status_passes(rest, method, status):
+    url = 'https://api.github.com/thing'
+    rest.responses[url] = make_response(status, {'ok': True} if status != 204 else None)
+
+    code, info, body = app.call_rest(method, '/thing', expected=(status,))
+    assert code == status
+
+    with pytest.raises(GithubAPIError):
+        app.call_rest(method, '/thing')
+
+
+@pytest.mark.asyncio
+async def test_async_unexpected_status_raises(api):
+    api.handler = lambda request: httpx.Response(404, json={'message': 'Not Found'})
+
+    with pytest.raises(GithubAPIError) as info:
+        await app_async.call_rest('GET', '/app')
+
+    assert isinstance(info.value, httpx.HTTPStatusError)
+    assert info.value.response.status_code == 404
+    assert info.value.status == 404
+    assert info.value.url == 'https://api.github.com/app'
+    assert 'Not Found' in info.value.body
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('method,status', [('POST', 201), ('DELETE', 204)])
+async def test_async_expected_status_passes(api, method, status):
+    api.handler = lambda request: httpx.Response(status)
+
+    code, info, body = await app_async.call_rest(method, '/thing', expected=(status,))
+    assert code == status
+
+    with pytest.raises(GithubAPIError):
+        await app_async.call_rest(method, '/thing')